@@ -1,12 +1,13 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+from bisect import bisect_left, bisect_right
 from textwrap import TextWrapper
 from cgi import escape
 
 from .compat import str, range
 from .utils import Record, assert_type
-from .multiline import Multiline, get_multilines
+from .multiline import _get_multilines
 from .color import (
     LINE,
     BACKGROUND,
@@ -24,6 +25,7 @@ __all__ = [
     'LineMarkup',
     'LineLabelMarkup',
     'AsciiMarkup',
+    'MarkupList',
 
     'markup',
     'show_markup'
@@ -32,6 +34,7 @@ __all__ = [
 
 class Span(Record):
     __attributes__ = ['start', 'stop', 'type']
+    __slots__ = __attributes__
 
     def __init__(self, start, stop, type=None):
         assert_type(start, int)
@@ -45,30 +48,33 @@ class Span(Record):
         self.type = type
 
     def __lt__(self, other):
-        if self.start != other.start:
-            return self.start < other.start
-        else:
-            if self.stop != other.stop:
-                return self.stop < other.stop
-            else:
-                if self.type != other.type:
-                    if self.type is None:
-                        return True
-                    if other.type is None:
-                        return False
-                    return self.type < other.type
-                else:
-                    return False  # eq
+        return span_key(self) < span_key(other)
+
+
+def span_key(span):
+    # same order as Span.__lt__, None type goes first
+    type = span.type
+    return span.start, span.stop, type is not None, type or ''
 
 
 class Html(object):
     def _repr_html_(self):
-        return ''.join(self.as_html)
+        # text and spans are not supposed to change after init
+        html = getattr(self, '_html_cache', None)
+        if html is None:
+            html = ''.join(self.as_html)
+            self._html_cache = html
+        return html
 
 
 class Ascii(object):
     def _repr_pretty_(self, printer, cycle):
-        for line in self.as_ascii:
+        # same as Html, render once
+        lines = getattr(self, '_ascii_cache', None)
+        if lines is None:
+            lines = list(self.as_ascii)
+            self._ascii_cache = lines
+        for line in lines:
             printer.text(line)
             printer.break_()
 
@@ -78,10 +84,30 @@ class Markup(Record):
 
     def __init__(self, text, spans):
         self.text = str(text)
+        spans = list(spans)
+        keys = []
         for span in spans:
             assert_type(span, Span)
-        self.spans = sorted(spans)
-        self.multilines = list(get_multilines(self.spans))
+            keys.append(span_key(span))
+        # spans often come sorted already, sort only when needed
+        if any(a > b for a, b in zip(keys, keys[1:])):
+            order = sorted(range(len(spans)), key=keys.__getitem__)
+            spans = [spans[_] for _ in order]
+        self.spans = spans
+        # spans are sorted by span_key, same order as sorted(spans)
+        self.multilines = list(_get_multilines(
+            (_.start, _.stop, _.type)
+            for _ in spans
+        ))
+
+
+class HtmlMarkup(Html, Markup):
+    # subclasses append html fragments to out in _build_html
+    @property
+    def as_html(self):
+        out = []
+        self._build_html(out)
+        return out
 
 
 def chunk_(text, spans):
@@ -99,54 +125,79 @@ def chunk(text, spans):
         yield escape(chunk), span
 
 
-class BoxMarkup(Html, Markup):
+BOX_DIV = (
+    '<div class="tex2jax_ignore" '
+    'style="white-space: pre-wrap">'
+)
+BOX_SPAN = (
+    '<span style="'
+    'padding: 0.15em; '
+    'border-radius: 0.25em; '
+    'border: 1px solid %s; '
+    'background: %s'
+    '">'
+)
+BOX_SUP = (
+    '<sup style="'
+    'font-size: 0.7em; '
+    'color: %s;'
+    '">'
+)
+
+
+def format_box_style(background, border, label):
+    return BOX_SPAN % (border, background), BOX_SUP % label
+
+
+SHADE_STYLE = format_box_style(
+    Shade.YELLOW,
+    Shade.DARK_YELLOW,
+    Shade.DARKER_YELLOW
+)
+
+
+def get_box_styles(spans):
+    # BACKGROUND assigns colors on first lookup, keep spans order
+    styles = {}
+    for span in spans:
+        type = span.type
+        if type not in styles:
+            background = BACKGROUND[type]
+            styles[type] = format_box_style(
+                background,
+                DARKER[background],
+                EVEN_DARKER[background]
+            )
+    return styles
+
+
+class BoxMarkup(HtmlMarkup):
     label = False
     color = True
 
-    @property
-    def as_html(self):
-        yield (
-            '<div class="tex2jax_ignore" '
-            'style="white-space: pre-wrap">'
-        )
+    def _build_html(self, out):
+        append = out.append
+        show_label = self.label
+        color = self.color
+        if color:
+            styles = get_box_styles(self.spans)
+
+        append(BOX_DIV)
         for text, span in chunk(self.text, self.spans):
             if not span:
-                yield text
+                append(text)
                 continue
 
-            if self.color:
-                background = BACKGROUND[span.type]
-                border = DARKER[background]
-                label = EVEN_DARKER[background]
+            if color:
+                span_style, sup_style = styles[span.type]
             else:
-                background = Shade.YELLOW
-                border = Shade.DARK_YELLOW
-                label = Shade.DARKER_YELLOW
-            yield (
-                '<span style="'
-                'padding: 0.15em; '
-                'border-radius: 0.25em; '
-                'border: 1px solid {border}; '
-                'background: {background}'
-                '">'.format(
-                    background=background,
-                    border=border
-                )
-            )
-            yield text
-            if self.label and span.type:
-                yield (
-                    '<sup style="'
-                    'font-size: 0.7em; '
-                    'color: {color};'
-                    '">'.format(
-                        color=label
-                    )
-                )
-                yield span.type
-                yield '</sup>'
-            yield '</span>'
-        yield '</div>'
+                span_style, sup_style = SHADE_STYLE
+            append(span_style)
+            append(text)
+            if show_label and span.type:
+                out.extend((sup_style, span.type, '</sup>'))
+            append('</span>')
+        append('</div>')
 
 
 class BoxLabelMarkup(BoxMarkup):
@@ -154,89 +205,121 @@ class BoxLabelMarkup(BoxMarkup):
     color = False
 
 
-class LineMarkup(Html, Markup):
-    @property
-    def as_html(self):
-        yield (
-            '<div class="tex2jax_ignore" style="'
-            'line-height: 1.6em; '
-            'white-space: pre-wrap'
-            '">'
-        )
+LINE_DIV = (
+    '<div class="tex2jax_ignore" style="'
+    'line-height: 1.6em; '
+    'white-space: pre-wrap'
+    '">'
+)
+LINE_SPAN = (
+    '<span style="'
+    'border-bottom: 2px solid %s; '
+    'padding-bottom: %dpx'
+    '">'
+)
+LINE_STYLES = {}
+
+
+def get_line_style(color, level):
+    key = color, level
+    style = LINE_STYLES.get(key)
+    if style is None:
+        padding = 1 + level * 3
+        style = LINE_SPAN % (color, padding)
+        LINE_STYLES[key] = style
+    return style
+
+
+class LineMarkup(HtmlMarkup):
+    def _build_html(self, out):
+        append = out.append
+        line_colors = LINE
+        line_style = get_line_style
+
+        append(LINE_DIV)
         for text, multi in chunk(self.text, self.multilines):
             if not multi:
-                yield text
+                append(text)
                 continue
 
             for line in multi.lines:
-                padding = 1 + line.level * 3
-                color = LINE[line.type]
-                yield (
-                    '<span style="'
-                    'border-bottom: 2px solid {color}; '
-                    'padding-bottom: {padding}px'
-                    '">'.format(
-                        padding=padding,
-                        color=color
-                    )
-                )
-            yield text
-            for _ in multi.lines:
-                yield '</span>'
-
-        yield '</div>'
-
-
-class LineLabelMarkup(Html, Markup):
-    @property
-    def as_html(self):
-        yield (
-            '<div style="'
-            'line-height: 1.6em; '  # 1.5 is default
-            'white-space: pre-wrap'
-            '">'
-        )
+                append(line_style(line_colors[line.type], line.level))
+            append(text)
+            out.extend('</span>' for _ in multi.lines)
+
+        append('</div>')
+
+
+LINE_LABEL_DIV = (
+    '<div style="'
+    'line-height: 1.6em; '  # 1.5 is default
+    'white-space: pre-wrap'
+    '">'
+)
+LINE_LABEL_SPAN = (
+    '<span style="'
+    'border-bottom: 2px solid %s; '
+    'padding-bottom: 1px'
+    '">' % Soft.BLUE
+)
+LINE_LABEL_TYPES = (
+    '<span style="'
+    'display: inline-block; '
+    'margin-left: 1px; '
+    'font-size: 7px;'
+    '">'
+)
+LINE_LABEL_TYPE = '<span style="display: block; height: 7px;">'
+
+
+class LineLabelMarkup(HtmlMarkup):
+    def _build_html(self, out):
+        append = out.append
+
+        append(LINE_LABEL_DIV)
         for text, multi in chunk(self.text, self.multilines):
             if not multi:
-                yield text
+                append(text)
                 continue
 
             if not text.strip():
-                yield text
+                append(text)
                 continue
 
-            yield (
-                '<span style="'
-                'border-bottom: 2px solid {color}; '
-                'padding-bottom: 1px'
-                '">'.format(
-                    color=Soft.BLUE
-                )
-            )
-            yield text
-            yield '</span>'
-
-            yield (
-                '<span style="'
-                'display: inline-block; '
-                'margin-left: 1px; '
-                'font-size: 7px;'
-                '">'
-            )
+            out.extend((LINE_LABEL_SPAN, text, '</span>', LINE_LABEL_TYPES))
             types = [
-                _.type
-                for _ in multi.lines
-                if _.type is not None
+                _ for _ in multi.types
+                if _ is not None
             ]
             if len(types) == 1:
-                yield types[0]
+                append(types[0])
             elif len(types) > 1:
-                for line in multi.lines:
-                    yield '<span style="display: block; height: 7px;">'
-                    yield line.type
-                    yield '</span>'
-            yield '</span>'
-        yield '</div>'
+                for type in multi.types:
+                    out.extend((LINE_LABEL_TYPE, type, '</span>'))
+            append('</span>')
+        append('</div>')
+
+
+class MarkupList(Html, Record):
+    __attributes__ = ['markups']
+
+    def __init__(self, markups):
+        markups = list(markups)
+        for markup in markups:
+            assert_type(markup, Html)
+        self.markups = markups
+
+    def _repr_html_(self):
+        # markups is a mutable list, render on every display
+        return ''.join(self.as_html)
+
+    @property
+    def as_html(self):
+        # all markups share one list and one join
+        out = []
+        for markup in self.markups:
+            out.extend(markup.as_html)
+        return out
 
 
 class Wrapper(TextWrapper):
@@ -251,8 +334,9 @@ class Wrapper(TextWrapper):
     def __call__(self, text):
         start = 0
         lines = text.splitlines()
+        last = len(lines) - 1
         for index, line in enumerate(lines):
-            if index < len(lines) - 1:
+            if index < last:
                 line = line + ' '  # replace \n with ' '
             for fold in self.wrap(line):
                 stop = start + len(fold)
@@ -260,57 +344,73 @@ class Wrapper(TextWrapper):
                 start = stop
 
 
+# wrap keeps no state between calls, share one wrapper per width
+WRAPPERS = {}
+
+
+def get_wrapper(width):
+    wrapper = WRAPPERS.get(width)
+    if wrapper is None:
+        wrapper = Wrapper(width)
+        WRAPPERS[width] = wrapper
+    return wrapper
+
+
+# \x0b, \x0c, \r are line breaks for splitlines in Wrapper, keep
+# them, replacing any of those changes wrapping
+ASCII_WHITESPACE = {
+    ord('\t'): ' '
+}
+
+
 class AsciiMarkup(Ascii, Markup):
     def __init__(self, text, spans, width=70):
         Markup.__init__(self, text, spans)
-        self.wrapper = Wrapper(width)
+        self.ascii_text = self.text.translate(ASCII_WHITESPACE)
+        self.wrapper = get_wrapper(width)
+        self.multi_starts = [_.start for _ in self.multilines]
+        self.multi_stops = [_.stop for _ in self.multilines]
 
     @property
     def as_ascii(self):
-        index = 0
-        for start, stop, line in self.wrapper(self.text):
-            slices = []
-            while index < len(self.multilines):
-                multi = self.multilines[index]
-                if multi.start >= stop:
-                    break
-                slice = Multiline(
-                    max(multi.start, start),
-                    min(multi.stop, stop),
-                    multi.lines
-                )
-                slices.append(slice)
-                if multi.stop <= stop:
-                    index += 1
-                else:
-                    break
-
-            yield line.replace('\t', ' ')
-
-            if slices:
-                height = max(
-                    line.level
-                    for slice in slices
-                    for line in slice.lines
-                ) + 1
+        for start, stop, line in self.wrapper(self.ascii_text):
+            # multilines do not overlap, so stops are sorted too
+            lower = bisect_right(self.multi_stops, start)
+            upper = bisect_left(self.multi_starts, stop, lower)
+            multis = self.multilines[lower:upper]
+
+            yield line
+
+            if multis:
                 width = len(line)
+                # multilines share Line objects, draw each line once
+                lines = {}
+                height = 0
+                for multi in multis:
+                    level = multi.levels[-1]  # lines are sorted by level
+                    if level >= height:
+                        height = level + 1
+                    for line in multi.lines:
+                        lines[id(line)] = line
+                lines = list(lines.values())
                 matrix = [
-                    [' ' for _ in range(width)]
+                    [' '] * width
                     for row in range(height)
                 ]
-                for slice in slices:
-                    for line in slice.lines:
-                        for x in range(slice.start, slice.stop):
-                            matrix[line.level][x - start] = '-'
-                for slice in slices:
-                    for line in slice.lines:
-                        if line.type and line.start == slice.start:
-                            size = line.stop - line.start
-                            space = width - (slice.start - start)
-                            type = line.type[:min(size, space)]
-                            for x, char in enumerate(type):
-                                x = slice.start - start + x
-                                matrix[line.level][x] = char
+                for line in lines:
+                    left = max(line.start, start) - start
+                    right = min(line.stop, stop) - start
+                    matrix[line.level][left:right] = ['-'] * (right - left)
+                for line in lines:
+                    if line.type and line.start >= start:
+                        left = line.start - start
+                        size = min(
+                            line.stop - line.start,
+                            width - left,
+                            len(line.type)
+                        )
+                        # full label is not copied by [:size]
+                        matrix[line.level][left:left + size] = line.type[:size]
                 for row in matrix:
                     yield ''.join(row)
 
@@ -10,6 +10,7 @@ from .utils import Record
 
 class Line(Record):
     __attributes__ = ['start', 'stop', 'type', 'level']
+    __slots__ = __attributes__
 
     def __init__(self, start, stop, type, level):
         self.start = start
@@ -40,6 +41,10 @@ class Multiline(Record):
         if not lines:
             lines = []
         self.lines = lines
+        # derived from lines, not in __attributes__, go stale if lines
+        # is mutated after init
+        self.levels = [_.level for _ in lines]
+        self.types = [_.type for _ in lines]
 
 
 def get_free_level(intervals):
@@ -51,10 +56,11 @@ def get_free_level(intervals):
     return max(levels) + 1
 
 
-def get_multilines(spans):
+def _get_multilines(items):
+    # items are (start, stop, type) triples, already sorted
     # level
     intervals = Intervals()
-    for start, stop, type in sorted(spans):
+    for start, stop, type in items:
         selected = intervals.search(start, stop)
         level = get_free_level(selected)
         intervals.addi(start, stop, Line(start, stop, type, level))
@@ -71,3 +77,7 @@ def get_multilines(spans):
         lines = groups[start, stop]
         lines = sorted(lines)
         yield Multiline(start, stop, lines)
+
+
+def get_multilines(spans):
+    return _get_multilines(sorted(spans))
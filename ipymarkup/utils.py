@@ -14,6 +14,7 @@ def assert_type(item, types):
 
 class Record(object):
     __attributes__ = []
+    __slots__ = ()
 
     def __eq__(self, other):
         return (
@@ -33,6 +34,18 @@ class Record(object):
     def __hash__(self):
         return hash(tuple(self))
 
+    # slots need explicit state for pickle protocols 0 and 1, keep
+    # __dict__ for subclasses without slots
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for key in self.__attributes__:
+            state[key] = getattr(self, key)
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
     def __repr__(self):
         name = self.__class__.__name__
         args = ', '.join(